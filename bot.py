@@ -9,11 +9,14 @@ import time
 import aiohttp
 import json
 import gc
+import heapq
 import psutil
-import glob
-from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from aiolimiter import AsyncLimiter
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes, MessageHandler, filters
+from telegram.error import BadRequest, Forbidden, RetryAfter
 
 # Configure logging
 logging.basicConfig(
@@ -29,8 +32,18 @@ BATCH_SIZE = 80
 MAX_CONCURRENT_TASKS = 2
 CSV_DOWNLOAD_INTERVAL = 10800  # 3 hours
 GROUP_CHECK_INTERVAL = 10800  # 3 hours (same as download interval)
+EXPIRY_REMINDER_INTERVAL = 86400  # Remind expiring users once per day
+EXPIRY_REMINDER_WINDOW = timedelta(days=3)
+JOB_RETRY_DELAY = 300  # Retry a failed background job after 5 minutes
+NOTIFY_RETRY_INTERVAL = 60  # Resend notifications deferred by Telegram flood control
 MAX_CSV_FILES_TO_KEEP = 2
 MEMORY_LIMIT_MB = 350
+TELEGRAM_MESSAGE_LIMIT = 4096  # Longest text a single Telegram message may carry
+TELEGRAM_CONCURRENCY = 10  # Bot API calls in flight at once
+TELEGRAM_RATE_PER_SEC = 25  # Stay under Telegram's ~30 requests/sec per bot
+STORAGE_LOG_INTERVAL = 60  # Minimum seconds between storage_usage rows
+STORAGE_CACHE_TTL = 60  # Seconds a storage usage measurement stays valid
+ADMIN_CACHE_TTL = 30  # Seconds /remove_expired and /group_stats reuse their last query
 # ==========================================================
 
 # Bot configuration
@@ -38,23 +51,200 @@ BOT_TOKEN = os.environ.get('BOT_TOKEN', '8216881905:AAFo0Lnufs8crn2IZ-p8gSaaxV3Q
 ADMIN_IDS = [int(id.strip()) for id in os.environ.get('ADMIN_IDS', '8085393860').split(',')]
 GROUP_CHAT_ID = int(os.environ.get('GROUP_CHAT_ID', '-1002965409390'))
 
+# Webhook delivery; Render web services provide PORT and RENDER_EXTERNAL_URL.
+# Without a public HTTPS URL the bot falls back to long polling.
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL', os.environ.get('RENDER_EXTERNAL_URL'))
+PORT = int(os.environ.get('PORT', '8443'))
+
+# Subscription lengths by CSV subscription_type; anything else is a one-time purchase
+SUBSCRIPTION_DURATIONS = {
+    'monthly': timedelta(days=30),
+    'yearly': timedelta(days=365),
+}
+ONE_TIME_DURATION = timedelta(days=365*10)
+
 # Encryption setup
+CREDENTIALS_FILE = 'credentials.enc'
+PLAIN_CREDENTIALS_FILE = 'credentials.json'  # used when no cipher is available
+
+# The key must be stable across restarts, otherwise saved credentials can't be read back
+FERNET_KEY = os.environ.get('FERNET_KEY')
 try:
     from cryptography.fernet import Fernet
-    ENCRYPTION_KEY = Fernet.generate_key()
-    cipher = Fernet(ENCRYPTION_KEY)
+    if FERNET_KEY:
+        cipher = Fernet(FERNET_KEY.encode())
+    else:
+        logger.warning("FERNET_KEY not set, storing credentials unencrypted")
+        cipher = None
 except ImportError:
-    logger.warning("Cryptography not available, using basic encoding")
+    logger.warning("Cryptography not available, storing credentials unencrypted")
+    cipher = None
+except ValueError:
+    logger.error("FERNET_KEY is not a valid Fernet key (generate one with Fernet.generate_key()), "
+                 "storing credentials unencrypted")
     cipher = None
 
 # Database setup
-def init_database():
-    conn = sqlite3.connect('payments.db', check_same_thread=False)
+DB_PATH = 'payments.db'
+CACHED_STATEMENTS = 256
+
+# Hot queries kept as module constants so every call hands sqlite3 the same
+# SQL text and hits the connection's prepared statement cache
+SQL_MY_STATUS = '''
+SELECT subscription_type, expires_date, payment_date, status,
+       (julianday(expires_date) - julianday('now', 'localtime')) * 86400 AS seconds_left
+FROM payments 
+WHERE user_id = ? AND status = 'completed'
+ORDER BY payment_date DESC 
+LIMIT 1
+'''
+
+# Two unique-index seeks; a transaction ID match wins over an order ID match
+SQL_VERIFY_PAYMENT = '''
+SELECT p.amount, p.currency, p.status, p.transaction_id, p.selar_order_id, p.payment_date,
+       p.subscription_type, p.expires_date, u.username, u.first_name, u.last_name
+FROM payments p 
+JOIN users u ON p.user_id = u.user_id 
+WHERE p.transaction_id = ?
+UNION ALL
+SELECT p.amount, p.currency, p.status, p.transaction_id, p.selar_order_id, p.payment_date,
+       p.subscription_type, p.expires_date, u.username, u.first_name, u.last_name
+FROM payments p 
+JOIN users u ON p.user_id = u.user_id 
+WHERE p.selar_order_id = ?
+LIMIT 1
+'''
+
+# All /stats counters in one round-trip to the database thread
+SQL_STATS = '''
+SELECT
+    (SELECT COUNT(*) FROM payments),
+    (SELECT COUNT(*) FROM payments WHERE status = 'completed'),
+    (SELECT COUNT(*) FROM users WHERE in_group = TRUE),
+    (SELECT COUNT(*) FROM group_members),
+    (SELECT COUNT(*) FROM payments WHERE expires_date < ? AND status = 'completed')
+'''
+
+# All /group_stats counters from a single pass over users JOIN payments
+SQL_GROUP_STATS = '''
+SELECT
+    (SELECT COUNT(*) FROM group_members),
+    COUNT(CASE WHEN p.status = 'completed' AND u.in_group = FALSE
+               AND p.expires_date > :now THEN 1 END),
+    COUNT(CASE WHEN p.status = 'completed' AND u.in_group = TRUE
+               AND p.expires_date < :now THEN 1 END),
+    (SELECT MAX(last_checked) FROM group_members)
+FROM users u
+JOIN payments p ON u.user_id = p.user_id
+'''
+
+# Anti-join active payments against the synced group members, skipping users
+# already added since the last sync (in_group is set as soon as they are added)
+SQL_FIND_MISSING_MEMBERS = '''
+SELECT u.user_id, u.username, u.first_name, u.last_name, p.selar_order_id
+FROM payments p
+JOIN users u ON u.user_id = p.user_id
+LEFT JOIN group_members g ON g.user_id = p.user_id
+WHERE g.user_id IS NULL AND u.in_group = FALSE AND p.status = 'completed'
+AND p.expires_date > ?
+GROUP BY p.user_id
+'''
+
+# Only the columns the automated removal needs; /remove_expired uses the full rows below
+SQL_FIND_EXPIRED_IDS = '''
+SELECT u.user_id, p.subscription_type, p.selar_order_id
+FROM users u
+JOIN payments p ON u.user_id = p.user_id
+WHERE u.in_group = TRUE
+AND p.expires_date < ?
+AND p.status = 'completed'
+'''
+
+SQL_FIND_EXPIRED_MEMBERS = '''
+SELECT u.user_id, u.username, u.first_name, u.last_name, p.subscription_type, p.expires_date, p.selar_order_id
+FROM users u
+JOIN payments p ON u.user_id = p.user_id
+WHERE u.in_group = TRUE
+AND p.expires_date < ?
+AND p.status = 'completed'
+'''
+
+# Expired members and soon-to-expire subscriptions from one range scan on expires_date
+SQL_SCAN_EXPIRY = '''
+SELECT u.user_id, p.subscription_type, p.selar_order_id, p.expires_date,
+       CASE WHEN p.expires_date < :now THEN 'expired' ELSE 'soon' END AS kind
+FROM users u
+JOIN payments p ON u.user_id = p.user_id
+WHERE p.status = 'completed'
+AND p.expires_date <= :soon
+AND (u.in_group = TRUE OR p.expires_date >= :now)
+'''
+
+# Group member sync, run every GROUP_CHECK_INTERVAL
+SQL_UPSERT_GROUP_MEMBER = '''
+INSERT INTO group_members (user_id, username, first_name, last_name, last_checked, status)
+VALUES (?, ?, ?, ?, ?, ?)
+ON CONFLICT(user_id) DO UPDATE SET
+    username = excluded.username,
+    first_name = excluded.first_name,
+    last_name = excluded.last_name,
+    last_checked = excluded.last_checked,
+    status = excluded.status
+'''
+
+SQL_PRUNE_GROUP_MEMBERS = 'DELETE FROM group_members WHERE last_checked < ?'
+
+# Only touch users whose membership flag actually flips
+SQL_REFRESH_IN_GROUP = '''
+UPDATE users
+SET in_group = EXISTS(SELECT 1 FROM group_members g WHERE g.user_id = users.user_id)
+WHERE in_group IS NOT EXISTS(SELECT 1 FROM group_members g WHERE g.user_id = users.user_id)
+'''
+
+SQL_SET_IN_GROUP = 'UPDATE users SET in_group = ? WHERE user_id = ?'
+
+SQL_RECORD_DOWNLOAD = '''
+INSERT INTO download_history (download_time, filename, file_size_mb, payments_processed, status)
+VALUES (?, ?, ?, ?, ?)
+'''
+
+SQL_RECORD_STORAGE = '''
+INSERT INTO storage_usage (check_time, total_used_mb, csv_files_mb, database_mb, available_mb)
+VALUES (?, ?, ?, ?, ?)
+'''
+
+def utc_now_sql(offset=timedelta(0)):
+    """Current UTC time (plus offset) in the same text format as SQLite's datetime('now')"""
+    return (datetime.now(timezone.utc) + offset).strftime('%Y-%m-%d %H:%M:%S')
+
+# Store datetimes as 'YYYY-MM-DD HH:MM:SS' and hand TIMESTAMP columns back as datetime objects
+sqlite3.register_adapter(datetime, lambda d: d.isoformat(sep=' ', timespec='seconds'))
+sqlite3.register_converter('TIMESTAMP', lambda s: datetime.fromisoformat(s.decode()))
+
+def connect_database(read_only=False):
+    """Open a connection to the payments database with our PRAGMAs applied"""
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False, cached_statements=CACHED_STATEMENTS,
+                           detect_types=sqlite3.PARSE_DECLTYPES)
     cursor = conn.cursor()
     
     cursor.execute('PRAGMA journal_mode=WAL')
     cursor.execute('PRAGMA synchronous = NORMAL')
-    cursor.execute('PRAGMA cache_size = -2000')
+    cursor.execute('PRAGMA cache_size = -64000')
+    cursor.execute('PRAGMA temp_store = MEMORY')
+    cursor.execute('PRAGMA mmap_size = 2147483648')
+    cursor.execute('PRAGMA busy_timeout = 5000')
+    cursor.execute('PRAGMA wal_autocheckpoint = 1000')
+    
+    # Reject writes without opening the file read-only (mode=ro), which would
+    # also rule out running PRAGMA optimize on this connection at shutdown
+    if read_only:
+        cursor.execute('PRAGMA query_only = ON')
+    
+    return conn
+
+def init_database():
+    conn = connect_database()
+    cursor = conn.cursor()
     
     # Existing tables
     cursor.execute('''
@@ -87,6 +277,13 @@ def init_database():
     )
     ''')
     
+    # group_members is rebuilt on every sync, so a table created before the
+    # switch to WITHOUT ROWID can simply be dropped and recreated
+    cursor.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'group_members'")
+    existing = cursor.fetchone()
+    if existing and 'WITHOUT ROWID' not in existing[0].upper():
+        cursor.execute('DROP TABLE group_members')
+    
     cursor.execute('''
     CREATE TABLE IF NOT EXISTS group_members (
         user_id INTEGER PRIMARY KEY,
@@ -95,7 +292,7 @@ def init_database():
         last_name TEXT,
         last_checked TIMESTAMP,
         status TEXT
-    )
+    ) WITHOUT ROWID
     ''')
     
     cursor.execute('''
@@ -126,11 +323,44 @@ def init_database():
     cursor.execute('CREATE INDEX IF NOT EXISTS idx_payments_expires ON payments(expires_date)')
     cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_in_group ON users(in_group)')
     
+    # Composite indexes matching the status, stats and group-sync queries
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_pay_user_status_date ON payments(user_id, status, payment_date DESC)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_pay_status_expires ON payments(status, expires_date)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_ingroup_uid ON users(in_group, user_id)')
+    
+    # Gather planner statistics until there is data to describe, so the composite
+    # indexes are picked up; PRAGMA optimize on both connections keeps them fresh
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'sqlite_stat1'")
+    if not cursor.fetchone() or not cursor.execute('SELECT 1 FROM sqlite_stat1 LIMIT 1').fetchone():
+        cursor.execute('ANALYZE')
+    
     conn.commit()
+    conn.execute('PRAGMA optimize')
     conn.close()
 
 init_database()
 
+def scan_csv_exports():
+    """List downloaded Selar CSV exports as os.DirEntry objects (stat results are cached per entry)"""
+    with os.scandir('.') as entries:
+        return [e for e in entries if e.name.startswith('selar_export_') and e.name.endswith('.csv')]
+
+def split_message(lines, limit=TELEGRAM_MESSAGE_LIMIT):
+    """Join message lines into as few chunks as possible, each at most limit characters"""
+    chunks, current, size = [], [], 0
+    for line in lines:
+        # A single oversized line is cut into limit-sized pieces
+        pieces = [line[i:i + limit] for i in range(0, len(line), limit)] or ['']
+        for piece in pieces:
+            if size + len(piece) > limit:
+                chunks.append(''.join(current))
+                current, size = [], 0
+            current.append(piece)
+            size += len(piece)
+    if current:
+        chunks.append(''.join(current))
+    return chunks
+
 class PaymentBot:
     def __init__(self):
         self.memory_limit_mb = MEMORY_LIMIT_MB
@@ -138,6 +368,25 @@ class PaymentBot:
         self.total_payments_processed = 0
         self.last_memory_check = time.time()
         self.last_group_check = time.time()
+        self.last_storage_log = 0
+        self.storage_cache = (0.0, None)  # (monotonic time measured, storage info)
+        self.expired_cache = (0.0, None)  # (monotonic time queried, expired users in group)
+        self.group_stats_cache = (0.0, None)  # (monotonic time queried, /group_stats counters)
+        self.telegram_semaphore = asyncio.Semaphore(TELEGRAM_CONCURRENCY)
+        self.telegram_rate = AsyncLimiter(TELEGRAM_RATE_PER_SEC, 1)
+        self.telegram_resume_at = 0.0  # monotonic time Telegram's flood control lets us send again
+        self.notify_queue = []  # (chat_id, text) messages waiting for flush_notifications()
+        self.expiry_scan = (0.0, None)  # (monotonic time scanned, expiring subscriptions)
+        
+        # One long-lived writer connection, only ever used from a single database
+        # thread so queries never block the event loop and writes are serialized
+        self.conn = connect_database()
+        self.db_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db')
+        
+        # A separate read-only connection on its own thread; in WAL mode its
+        # SELECTs never wait behind a long write such as /process
+        self.read_conn = connect_database(read_only=True)
+        self.read_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db-read')
         
         self.application = Application.builder().token(BOT_TOKEN).build()
         self.setup_handlers()
@@ -154,23 +403,69 @@ class PaymentBot:
     def load_credentials(self):
         """Load credentials from file if exists"""
         try:
-            if os.path.exists('credentials.json'):
-                with open('credentials.json', 'r') as f:
+            if cipher and os.path.exists(CREDENTIALS_FILE):
+                with open(CREDENTIALS_FILE, 'rb') as f:
+                    data = json.loads(cipher.decrypt(f.read()))
+                return data.get('email'), data.get('password')
+            
+            if os.path.exists(PLAIN_CREDENTIALS_FILE):
+                with open(PLAIN_CREDENTIALS_FILE, 'r') as f:
                     data = json.load(f)
-                    return data.get('email'), data.get('password')
-        except:
-            pass
+                email, password = data.get('email'), data.get('password')
+                # Migrate a plaintext file from before encryption was configured
+                if cipher and self.save_credentials(email, password):
+                    logger.info(f"Encrypted saved credentials into {CREDENTIALS_FILE}")
+                return email, password
+        except Exception as e:
+            logger.error(f"Error loading credentials: {e}")
         return None, None
     
     def save_credentials(self, email, password):
-        """Save credentials to file"""
+        """Save credentials to file, encrypted when a cipher is available"""
         try:
-            with open('credentials.json', 'w') as f:
-                json.dump({'email': email, 'password': password}, f)
+            data = json.dumps({'email': email, 'password': password})
+            if cipher:
+                with open(CREDENTIALS_FILE, 'wb') as f:
+                    f.write(cipher.encrypt(data.encode()))
+                # Don't leave an older plaintext copy behind
+                if os.path.exists(PLAIN_CREDENTIALS_FILE):
+                    os.remove(PLAIN_CREDENTIALS_FILE)
+            else:
+                with open(PLAIN_CREDENTIALS_FILE, 'w') as f:
+                    f.write(data)
             return True
-        except:
+        except Exception as e:
+            logger.error(f"Error saving credentials: {e}")
             return False
     
+    async def run_db(self, func, *args):
+        """Run a blocking database function on the database thread"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.db_executor, func, *args)
+    
+    async def run_read(self, func, *args):
+        """Run a blocking read-only database function on the reader thread"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.read_executor, func, *args)
+    
+    def read_fetchone(self, sql, params=()):
+        """Run a query on the read-only connection and return its first row"""
+        return self.read_conn.execute(sql, params).fetchone()
+    
+    def read_fetchall(self, sql, params=()):
+        """Run a query on the read-only connection and return all rows"""
+        return self.read_conn.execute(sql, params).fetchall()
+    
+    def db_execute(self, sql, params=()):
+        """Run a write statement in its own transaction"""
+        with self.conn:
+            self.conn.execute(sql, params)
+    
+    def db_executemany(self, sql, seq_of_params):
+        """Run a write statement for every parameter set in one transaction"""
+        with self.conn:
+            self.conn.executemany(sql, seq_of_params)
+    
     def setup_handlers(self):
         """Setup bot command handlers"""
         self.application.add_handler(CommandHandler("start", self.start))
@@ -200,42 +495,22 @@ class PaymentBot:
         user_id = update.effective_user.id
         
         try:
-            conn = sqlite3.connect('payments.db')
-            cursor = conn.cursor()
-            
             # Get user's active subscription
-            cursor.execute('''
-            SELECT subscription_type, expires_date, payment_date, status 
-            FROM payments 
-            WHERE user_id = ? AND status = 'completed'
-            ORDER BY payment_date DESC 
-            LIMIT 1
-            ''', (user_id,))
-            
-            subscription = cursor.fetchone()
-            conn.close()
+            subscription = await self.run_read(self.read_fetchone, SQL_MY_STATUS, (user_id,))
             
             if subscription:
-                sub_type, expires_date, payment_date, status = subscription
-                
-                # Calculate time remaining
-                now = datetime.now()
-                if isinstance(expires_date, str):
-                    expires_date = datetime.strptime(expires_date, '%Y-%m-%d %H:%M:%S')
-                
-                time_remaining = expires_date - now
+                sub_type, expires_date, payment_date, status, seconds_left = subscription
                 
-                if time_remaining.total_seconds() <= 0:
+                # SQLite already computed the time remaining in seconds
+                if seconds_left is None or seconds_left <= 0:
                     status_text = "❌ Your subscription has EXPIRED"
                 else:
                     # Calculate years, months, days, hours, minutes, seconds
-                    days = time_remaining.days
-                    years = days // 365
-                    months = (days % 365) // 30
-                    remaining_days = (days % 365) % 30
-                    hours = time_remaining.seconds // 3600
-                    minutes = (time_remaining.seconds % 3600) // 60
-                    seconds = time_remaining.seconds % 60
+                    days, remainder = divmod(int(seconds_left), 86400)
+                    years, days = divmod(days, 365)
+                    months, remaining_days = divmod(days, 30)
+                    hours, remainder = divmod(remainder, 3600)
+                    minutes, seconds = divmod(remainder, 60)
                     
                     status_text = f"""
 ✅ Your Subscription Status:
@@ -271,31 +546,23 @@ class PaymentBot:
             return
         
         transaction_id = context.args[0]
-        conn = sqlite3.connect('payments.db')
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-        SELECT p.*, u.username, u.first_name, u.last_name 
-        FROM payments p 
-        JOIN users u ON p.user_id = u.user_id 
-        WHERE p.transaction_id = ? OR p.selar_order_id = ?
-        ''', (transaction_id, transaction_id))
-        
-        payment = cursor.fetchone()
-        conn.close()
+        payment = await self.run_read(self.read_fetchone, SQL_VERIFY_PAYMENT, (transaction_id, transaction_id))
         
         if payment:
+            (amount, currency, status, txn_id, order_id, payment_date,
+             sub_type, expires_date, username, first_name, last_name) = payment
+            
             status_text = f"""
 ✅ Payment Verified
 
-👤 User: {payment[8]} {payment[9]} (@{payment[7]})
-💰 Amount: {payment[2]} {payment[3]}
-📅 Date: {payment[6]}
-🆔 Transaction ID: {payment[5]}
-📦 Order ID: {payment[4]}
-📝 Status: {payment[3]}
-🔐 Subscription: {payment[8]}
-⏰ Expires: {payment[9]}
+👤 User: {first_name} {last_name} (@{username})
+💰 Amount: {amount} {currency}
+📅 Date: {payment_date}
+🆔 Transaction ID: {txn_id}
+📦 Order ID: {order_id}
+📝 Status: {status}
+🔐 Subscription: {sub_type}
+⏰ Expires: {expires_date}
             """
             await update.message.reply_text(status_text)
         else:
@@ -309,26 +576,8 @@ class PaymentBot:
             await update.message.reply_text("❌ Access denied. Admin only.")
             return
         
-        conn = sqlite3.connect('payments.db')
-        cursor = conn.cursor()
-        
-        cursor.execute('SELECT COUNT(*) FROM payments')
-        total_payments = cursor.fetchone()[0]
-        
-        cursor.execute('SELECT COUNT(*) FROM payments WHERE status = "completed"')
-        completed_payments = cursor.fetchone()[0]
-        
-        cursor.execute('SELECT COUNT(*) FROM users WHERE in_group = TRUE')
-        users_in_group = cursor.fetchone()[0]
-        
-        cursor.execute('SELECT COUNT(*) FROM group_members')
-        group_members = cursor.fetchone()[0]
-        
-        # Get expired subscriptions count
-        cursor.execute('SELECT COUNT(*) FROM payments WHERE expires_date < datetime("now") AND status = "completed"')
-        expired_subscriptions = cursor.fetchone()[0]
-        
-        conn.close()
+        (total_payments, completed_payments, users_in_group,
+         group_members, expired_subscriptions) = await self.run_read(self.read_fetchone, SQL_STATS, (utc_now_sql(),))
         
         stats_text = f"""
 📊 Bot Statistics
@@ -396,19 +645,13 @@ class PaymentBot:
             return
         
         await update.message.reply_text("⏳ Downloading CSV file...")
-        success, filename = await self.download_with_storage_management()
+        success, filename, size_bytes = await self.download_with_storage_management()
         
         if success:
-            file_size_mb = os.path.getsize(filename) / 1024 / 1024 if os.path.exists(filename) else 0
+            file_size_mb = size_bytes / 1024 / 1024
             
-            conn = sqlite3.connect('payments.db')
-            cursor = conn.cursor()
-            cursor.execute('''
-            INSERT INTO download_history (download_time, filename, file_size_mb, payments_processed, status)
-            VALUES (?, ?, ?, ?, ?)
-            ''', (datetime.now(), filename, file_size_mb, 0, 'downloaded'))
-            conn.commit()
-            conn.close()
+            await self.run_db(self.db_execute, SQL_RECORD_DOWNLOAD,
+                              (datetime.now(), filename, file_size_mb, 0, 'downloaded'))
             
             await update.message.reply_text(f"✅ CSV downloaded: {filename} ({file_size_mb:.2f} MB)")
         else:
@@ -430,7 +673,7 @@ class PaymentBot:
         await update.message.reply_text("⏳ Processing payments...")
         
         try:
-            csv_files = glob.glob("selar_export_*.csv")
+            csv_files = [e.name for e in scan_csv_exports()]
             if not csv_files:
                 await update.message.reply_text("❌ No CSV files found. Download first with /download")
                 self.processing = False
@@ -442,21 +685,18 @@ class PaymentBot:
                 processed_count += count
             
             # Update download history
-            conn = sqlite3.connect('payments.db')
-            cursor = conn.cursor()
-            for csv_file in csv_files:
-                cursor.execute('''
-                UPDATE download_history 
-                SET payments_processed = payments_processed + ?, status = 'processed'
-                WHERE filename = ?
-                ''', (processed_count, csv_file))
-            conn.commit()
-            conn.close()
+            await self.run_db(self.db_executemany, '''
+            UPDATE download_history 
+            SET payments_processed = payments_processed + ?, status = 'processed'
+            WHERE filename = ?
+            ''', [(processed_count, csv_file) for csv_file in csv_files])
             
             # After processing, check for users to add/remove
             await self.check_group_members()
-            added_count = await self.add_missing_users_to_group()
-            removed_count = await self.remove_expired_users_from_group()
+            now = utc_now_sql()
+            added_count = await self.add_missing_users_to_group(now)
+            removed_count = await self.remove_expired_users_from_group(now)
+            await self.flush_notifications()
             
             await update.message.reply_text(
                 f"✅ Processed {processed_count} payments from {len(csv_files)} files.\n"
@@ -472,25 +712,28 @@ class PaymentBot:
     
     async def process_csv_file(self, filename):
         """Process a single CSV file"""
+        processed_count = await self.run_db(self.import_csv_file, filename)
+        if processed_count:
+            self.invalidate_group_caches()
+        return processed_count
+    
+    def import_csv_file(self, filename):
+        """Parse a CSV export and insert its payments (runs on the database thread)"""
         processed_count = 0
         try:
+            user_rows = []
+            payment_rows = []
+            now = datetime.now()
+            
             with open(filename, 'r', encoding='utf-8') as file:
                 reader = csv.DictReader(file)
                 
-                conn = sqlite3.connect('payments.db')
-                cursor = conn.cursor()
-                
                 for row in reader:
                     try:
                         # Extract order ID first (this should never be deleted)
                         selar_order_id = row.get('order_id', '') or row.get('selar_order_id', '')
                         if not selar_order_id:
                             continue
-                            
-                        # Check if this order has already been processed
-                        cursor.execute('SELECT COUNT(*) FROM payments WHERE selar_order_id = ?', (selar_order_id,))
-                        if cursor.fetchone()[0] > 0:
-                            continue  # Skip already processed orders
                         
                         # Extract user info from the row
                         user_id = int(row.get('user_id', 0)) or int(row.get('telegram_id', 0))
@@ -503,47 +746,75 @@ class PaymentBot:
                         amount = float(row.get('amount', 0))
                         currency = row.get('currency', 'USD')
                         status = row.get('status', 'completed')
-                        transaction_id = row.get('transaction_id', '')
+                        # Blank ids are stored as NULL so they don't collide under UNIQUE
+                        transaction_id = row.get('transaction_id') or None
                         payment_date_str = row.get('payment_date', '')
                         subscription_type = row.get('subscription_type', 'one_time')
                         
                         # Parse payment date
                         try:
-                            payment_date = datetime.strptime(payment_date_str, '%Y-%m-%d %H:%M:%S')
-                        except:
-                            payment_date = datetime.now()
-                        
-                        # Calculate expiration date based on subscription type
-                        if subscription_type.lower() == 'monthly':
-                            expires_date = payment_date + timedelta(days=29, hours=24)
-                        elif subscription_type.lower() == 'yearly':
-                            expires_date = payment_date + timedelta(days=364, hours=24)
-                        else:
-                            expires_date = payment_date + timedelta(days=365*10)  # 10 years for one-time
+                            payment_date = datetime.fromisoformat(payment_date_str)
+                        except (TypeError, ValueError):
+                            payment_date = now
                         
-                        # Insert or update user
-                        cursor.execute('''
-                        INSERT OR IGNORE INTO users (user_id, username, first_name, last_name, joined_date)
-                        VALUES (?, ?, ?, ?, ?)
-                        ''', (user_id, username, first_name, last_name, datetime.now()))
+                        # Offsets like 'Z' or '+01:00' are converted so every row is naive local time
+                        if payment_date.tzinfo:
+                            payment_date = payment_date.astimezone().replace(tzinfo=None)
                         
-                        # Insert payment with order ID tracking
-                        cursor.execute('''
-                        INSERT INTO payments 
-                        (user_id, amount, currency, status, transaction_id, selar_order_id, 
-                         payment_date, subscription_type, expires_date, processed_order)
-                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                        ''', (user_id, amount, currency, status, transaction_id, selar_order_id, 
-                              payment_date, subscription_type, expires_date, True))
+                        # Calculate expiration date based on subscription type
+                        expires_date = payment_date + SUBSCRIPTION_DURATIONS.get(subscription_type.lower(), ONE_TIME_DURATION)
                         
-                        processed_count += 1
+                        user_rows.append((user_id, username, first_name, last_name, now))
+                        payment_rows.append((user_id, amount, currency, status, transaction_id, selar_order_id,
+                                             payment_date, subscription_type, expires_date, True))
                         
                     except Exception as e:
                         logger.error(f"Error processing row: {e}")
                         continue
+            
+            if not payment_rows:
+                return 0
+            
+            # Stage the parsed rows in a temp table and let SQLite do the anti-join
+            # in one pass; the UNIQUE(selar_order_id) constraint makes
+            # INSERT OR IGNORE skip already processed orders
+            with self.conn:
+                cursor = self.conn.cursor()
+                cursor.executemany('''
+                INSERT OR IGNORE INTO users (user_id, username, first_name, last_name, joined_date)
+                VALUES (?, ?, ?, ?, ?)
+                ''', user_rows)
+                
+                cursor.execute('DROP TABLE IF EXISTS temp.stage_payments')
+                cursor.execute('CREATE TEMP TABLE stage_payments AS SELECT * FROM payments WHERE 0')
+                cursor.executemany('''
+                INSERT INTO stage_payments 
+                (user_id, amount, currency, status, transaction_id, selar_order_id, 
+                 payment_date, subscription_type, expires_date, processed_order)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ''', payment_rows)
+                
+                cursor.execute('''
+                INSERT OR IGNORE INTO payments 
+                (user_id, amount, currency, status, transaction_id, selar_order_id, 
+                 payment_date, subscription_type, expires_date, processed_order)
+                SELECT user_id, amount, currency, status, transaction_id, selar_order_id, 
+                       payment_date, subscription_type, expires_date, processed_order
+                FROM stage_payments
+                ''')
+                processed_count = cursor.rowcount
+                
+                # Already processed orders are expected; anything else was dropped by another constraint
+                cursor.execute('''
+                SELECT s.selar_order_id, s.transaction_id
+                FROM stage_payments s
+                WHERE NOT EXISTS (SELECT 1 FROM payments p WHERE p.selar_order_id = s.selar_order_id)
+                ''')
+                for selar_order_id, transaction_id in cursor.fetchall():
+                    logger.warning(f"Skipped order {selar_order_id} from {filename}: "
+                                   f"transaction ID {transaction_id} is already recorded")
                 
-                conn.commit()
-                conn.close()
+                cursor.execute('DROP TABLE stage_payments')
                 
         except Exception as e:
             logger.error(f"Error processing CSV file {filename}: {e}")
@@ -552,38 +823,50 @@ class PaymentBot:
     
     def calculate_storage_usage(self):
         """Calculate current storage usage and available space"""
+        measured_at, storage_info = self.storage_cache
+        if storage_info and time.monotonic() - measured_at < STORAGE_CACHE_TTL:
+            return storage_info
+        
         try:
             # Calculate CSV files size
-            csv_files = glob.glob("selar_export_*.csv")
-            csv_size_mb = sum(os.path.getsize(f) for f in csv_files) / 1024 / 1024
+            csv_size_mb = sum(e.stat().st_size for e in scan_csv_exports()) / 1024 / 1024
             
             # Calculate database size
-            db_size_mb = os.path.getsize('payments.db') / 1024 / 1024 if os.path.exists('payments.db') else 0
+            try:
+                db_size_mb = os.stat(DB_PATH).st_size / 1024 / 1024
+            except FileNotFoundError:
+                db_size_mb = 0
             
             total_used_mb = csv_size_mb + db_size_mb
             available_mb = MAX_STORAGE_MB - total_used_mb
             
-            # Record storage usage
-            conn = sqlite3.connect('payments.db')
-            cursor = conn.cursor()
-            cursor.execute('''
-            INSERT INTO storage_usage (check_time, total_used_mb, csv_files_mb, database_mb, available_mb)
-            VALUES (?, ?, ?, ?, ?)
-            ''', (datetime.now(), total_used_mb, csv_size_mb, db_size_mb, available_mb))
-            conn.commit()
-            conn.close()
-            
-            return {
+            storage_info = {
                 'total_used_mb': total_used_mb,
                 'csv_files_mb': csv_size_mb,
                 'database_mb': db_size_mb,
                 'available_mb': available_mb
             }
+            self.storage_cache = (time.monotonic(), storage_info)
+            return storage_info
             
         except Exception as e:
             logger.error(f"Error calculating storage usage: {e}")
             return None
     
+    async def record_storage_usage(self, storage_info):
+        """Record a storage usage sample, at most once per STORAGE_LOG_INTERVAL"""
+        if time.time() - self.last_storage_log <= STORAGE_LOG_INTERVAL:
+            return
+        
+        try:
+            await self.run_db(self.db_execute, SQL_RECORD_STORAGE,
+                              (datetime.now(), storage_info['total_used_mb'], storage_info['csv_files_mb'],
+                               storage_info['database_mb'], storage_info['available_mb']))
+            self.last_storage_log = time.time()
+            
+        except Exception as e:
+            logger.error(f"Error recording storage usage: {e}")
+    
     def should_download_more_data(self):
         """Check if we have space for more downloads"""
         storage_info = self.calculate_storage_usage()
@@ -596,18 +879,18 @@ class PaymentBot:
     def cleanup_oldest_csv(self):
         """Delete oldest CSV file to free up space"""
         try:
-            csv_files = glob.glob("selar_export_*.csv")
+            csv_files = scan_csv_exports()
             if not csv_files:
                 return False
                 
-            # Sort by modification time (oldest first)
-            csv_files.sort(key=os.path.getmtime)
-            oldest_file = csv_files[0]
+            # Pick the oldest file by modification time
+            oldest_file = min(csv_files, key=lambda e: e.stat().st_mtime)
             
             # Delete the file
-            file_size_mb = os.path.getsize(oldest_file) / 1024 / 1024
-            os.remove(oldest_file)
-            logger.info(f"Freed {file_size_mb:.2f} MB by deleting {oldest_file}")
+            file_size_mb = oldest_file.stat().st_size / 1024 / 1024
+            os.remove(oldest_file.path)
+            self.storage_cache = (0.0, None)
+            logger.info(f"Freed {file_size_mb:.2f} MB by deleting {oldest_file.name}")
             return True
             
         except Exception as e:
@@ -615,7 +898,7 @@ class PaymentBot:
             return False
     
     async def download_selar_csv(self):
-        """Download CSV from Selar (implementation depends on Selar API)"""
+        """Download CSV from Selar (implementation depends on Selar API); returns (success, filename or error, size in bytes)"""
         # This is a placeholder - you'll need to implement the actual Selar API integration
         try:
             # Simulate download
@@ -624,22 +907,26 @@ class PaymentBot:
                 f.write("order_id,user_id,username,first_name,last_name,amount,currency,status,payment_date,subscription_type,transaction_id\n")
                 # Add sample data
                 f.write("ORD123,123456789,testuser,Test,User,10.00,USD,completed,2023-01-01 12:00:00,monthly,TXN123\n")
+                size_bytes = f.tell()
             
-            return True, filename
+            return True, filename, size_bytes
         except Exception as e:
             logger.error(f"Error downloading CSV: {e}")
-            return False, str(e)
+            return False, str(e), 0
     
     async def download_with_storage_management(self):
-        """Download CSV with storage awareness"""
+        """Download CSV with storage awareness; returns (success, filename or error, size in bytes)"""
         if not self.should_download_more_data():
             logger.warning("Storage limit reached, cleaning up before download")
             if not self.cleanup_oldest_csv():
                 logger.error("Could not free up space for new download")
-                return False, "Storage limit reached"
+                return False, "Storage limit reached", 0
         
         # Proceed with download
-        return await self.download_selar_csv()
+        success, filename, size_bytes = await self.download_selar_csv()
+        if success:
+            self.storage_cache = (0.0, None)
+        return success, filename, size_bytes
     
     async def check_group_members(self):
         """Check all group members and update database"""
@@ -662,55 +949,36 @@ class PaymentBot:
                 return
             
             # Update group members in database
-            conn = sqlite3.connect('payments.db')
-            cursor = conn.cursor()
-            
-            # Clear existing group members
-            cursor.execute('DELETE FROM group_members')
-            
-            # Insert current members
-            for member in group_members:
-                cursor.execute('''
-                INSERT INTO group_members (user_id, username, first_name, last_name, last_checked, status)
-                VALUES (?, ?, ?, ?, ?, ?)
-                ''', (
-                    member['user_id'], member['username'], member['first_name'],
-                    member['last_name'], datetime.now(), member['status']
-                ))
+            now = datetime.now()
+            rows = [(m['user_id'], m['username'], m['first_name'], m['last_name'], now, m['status'])
+                    for m in group_members]
             
-            # Update user records with group status
-            cursor.execute('UPDATE users SET in_group = FALSE')
-            
-            user_ids_in_group = [str(m['user_id']) for m in group_members]
-            if user_ids_in_group:
-                placeholders = ','.join('?' * len(user_ids_in_group))
-                cursor.execute(f'UPDATE users SET in_group = TRUE WHERE user_id IN ({placeholders})', user_ids_in_group)
-            
-            conn.commit()
-            conn.close()
+            await self.run_db(self.store_group_members, rows, now)
+            self.invalidate_group_caches()
             
             logger.info(f"Updated {len(group_members)} group members in database")
             
         except Exception as e:
             logger.error(f"Error in group member check: {e}")
     
-    async def find_missing_group_members(self):
-        """Find paid users who are not in the group"""
-        try:
-            conn = sqlite3.connect('payments.db')
-            cursor = conn.cursor()
+    def store_group_members(self, rows, run_started):
+        """Upsert the current group members, prune departed ones and refresh users.in_group in one transaction"""
+        with self.conn:
+            cursor = self.conn.cursor()
             
-            # Find users with completed payments but not in group
-            cursor.execute('''
-            SELECT u.user_id, u.username, u.first_name, u.last_name, p.selar_order_id
-            FROM users u
-            JOIN payments p ON u.user_id = p.user_id
-            WHERE p.status = 'completed' AND u.in_group = FALSE
-            AND p.expires_date > datetime('now')
-            ''')
+            # Insert new members and refresh existing ones
+            cursor.executemany(SQL_UPSERT_GROUP_MEMBER, rows)
             
-            missing_users = cursor.fetchall()
-            conn.close()
+            # Anyone not seen in this run has left the group
+            cursor.execute(SQL_PRUNE_GROUP_MEMBERS, (run_started,))
+            
+            # Update user records with group status
+            cursor.execute(SQL_REFRESH_IN_GROUP)
+    
+    async def find_missing_group_members(self, now=None):
+        """Find paid users who are not in the group"""
+        try:
+            missing_users = await self.run_read(self.read_fetchall, SQL_FIND_MISSING_MEMBERS, (now or utc_now_sql(),))
             
             return missing_users
             
@@ -718,121 +986,181 @@ class PaymentBot:
             logger.error(f"Error finding missing group members: {e}")
             return []
     
-    async def add_missing_users_to_group(self):
+    def check_flood_wait(self):
+        """Raise RetryAfter while a Telegram flood control window is still open"""
+        wait = self.telegram_resume_at - time.monotonic()
+        if wait > 0:
+            raise RetryAfter(int(wait) + 1)
+    
+    async def telegram_call(self, method, *args, **kwargs):
+        """Call a Telegram Bot API method within the concurrency and rate limits, failing fast during a flood wait"""
+        # Fail before taking a semaphore slot or rate limiter token
+        self.check_flood_wait()
+        async with self.telegram_semaphore, self.telegram_rate:
+            # Another call may have hit flood control while this one waited
+            self.check_flood_wait()
+            try:
+                return await method(*args, **kwargs)
+            except RetryAfter as e:
+                self.telegram_resume_at = max(self.telegram_resume_at, time.monotonic() + e.retry_after)
+                logger.warning(f"Telegram flood control, pausing API calls for {e.retry_after}s")
+                raise
+    
+    async def add_missing_users_to_group(self, now=None):
         """Add users who have paid but are not in the group"""
-        missing_users = await self.find_missing_group_members()
+        missing_users = await self.find_missing_group_members(now)
         
         if not missing_users:
             logger.info("No missing users found")
             return 0
         
-        added_count = 0
-        for user_id, username, first_name, last_name, order_id in missing_users:
+        async def add_one(user_id, first_name, last_name):
             try:
-                # Check if user is already in group (double-check)
-                try:
-                    chat_member = await self.application.bot.get_chat_member(GROUP_CHAT_ID, user_id)
-                    if chat_member.status in ['member', 'administrator', 'creator']:
-                        # User is actually in group, update database
-                        conn = sqlite3.connect('payments.db')
-                        cursor = conn.cursor()
-                        cursor.execute('UPDATE users SET in_group = TRUE WHERE user_id = ?', (user_id,))
-                        conn.commit()
-                        conn.close()
-                        continue
-                except:
-                    pass  # User is not in group
-                
                 # Add user to group
-                await self.application.bot.add_chat_member(GROUP_CHAT_ID, user_id)
-                await asyncio.sleep(1)  # Rate limiting
+                await self.telegram_call(self.application.bot.add_chat_member, GROUP_CHAT_ID, user_id)
+                logger.info(f"Added missing user to group: {user_id} ({first_name} {last_name})")
                 
-                # Update database
-                conn = sqlite3.connect('payments.db')
-                cursor = conn.cursor()
-                cursor.execute('UPDATE users SET in_group = TRUE WHERE user_id = ?', (user_id,))
-                conn.commit()
-                conn.close()
+                # Queue welcome message
+                self.notify_queue.append(
+                    (user_id, f"👋 Welcome to the group, {first_name}! Your payment has been verified.")
+                )
                 
-                added_count += 1
-                logger.info(f"Added missing user to group: {user_id} ({first_name} {last_name})")
+                return user_id
                 
-                # Send welcome message
-                try:
-                    await self.application.bot.send_message(
-                        chat_id=user_id,
-                        text=f"👋 Welcome to the group, {first_name}! Your payment has been verified."
-                    )
-                except:
-                    pass  # Could not send message
-                    
             except Exception as e:
                 logger.error(f"Error adding user {user_id} to group: {e}")
+                return None
+        
+        results = await asyncio.gather(*(
+            add_one(user_id, first_name, last_name)
+            for user_id, username, first_name, last_name, order_id in missing_users
+        ))
+        added_ids = [uid for uid in results if uid is not None]
         
-        return added_count
+        # Update database in one transaction
+        if added_ids:
+            await self.run_db(self.db_executemany, SQL_SET_IN_GROUP, [(True, uid) for uid in added_ids])
+            self.invalidate_group_caches()
+        
+        return len(added_ids)
+    
+    def invalidate_group_caches(self):
+        """Drop cached admin query results after payments or group membership change"""
+        self.expired_cache = (0.0, None)
+        self.group_stats_cache = (0.0, None)
     
-    async def find_expired_users_in_group(self):
-        """Find users with expired subscriptions who are still in the group"""
+    async def find_expired_users_in_group(self, now=None):
+        """Find users with expired subscriptions who are still in the group (cached for ADMIN_CACHE_TTL when now is not given)"""
+        if now is None:
+            queried_at, expired_users = self.expired_cache
+            if expired_users is not None and time.monotonic() - queried_at < ADMIN_CACHE_TTL:
+                return expired_users
+        
         try:
-            conn = sqlite3.connect('payments.db')
-            cursor = conn.cursor()
-            
-            cursor.execute('''
-            SELECT u.user_id, u.username, u.first_name, u.last_name, p.subscription_type, p.expires_date, p.selar_order_id
-            FROM users u
-            JOIN payments p ON u.user_id = p.user_id
-            WHERE u.in_group = TRUE 
-            AND p.expires_date < datetime('now')
-            AND p.status = 'completed'
-            ''')
-            
-            expired_users = cursor.fetchall()
-            conn.close()
+            expired_users = await self.run_read(self.read_fetchall, SQL_FIND_EXPIRED_MEMBERS, (now or utc_now_sql(),))
+            if now is None:
+                self.expired_cache = (time.monotonic(), expired_users)
             return expired_users
             
         except Exception as e:
             logger.error(f"Error finding expired users: {e}")
             return []
     
-    async def remove_expired_users_from_group(self):
+    async def find_expired_user_ids(self, now=None):
+        """Find (user_id, subscription_type, order_id) of expired users who are still in the group"""
+        try:
+            return await self.run_read(self.read_fetchall, SQL_FIND_EXPIRED_IDS, (now or utc_now_sql(),))
+            
+        except Exception as e:
+            logger.error(f"Error finding expired users: {e}")
+            return []
+    
+    async def ban_expired_user(self, user_id, sub_type, order_id):
+        """Remove one expired user from the group and queue their notice; raises if the ban fails"""
+        await self.telegram_call(self.application.bot.ban_chat_member, GROUP_CHAT_ID, user_id)
+        logger.info(f"Removed expired user from group: {user_id} (Order: {order_id})")
+        
+        # Queue notification to user
+        self.notify_queue.append(
+            (user_id, f"❌ Your {sub_type} subscription has expired. You've been removed from the group. Please renew to regain access.")
+        )
+    
+    async def flush_notifications(self):
+        """Send all queued notifications concurrently within the Telegram limits"""
+        # Leave the queue alone until flood control lifts
+        if not self.notify_queue or self.telegram_resume_at > time.monotonic():
+            return 0
+        
+        pending, self.notify_queue = self.notify_queue, []
+        results = await asyncio.gather(*(
+            self.telegram_call(self.application.bot.send_message, chat_id=chat_id, text=text)
+            for chat_id, text in pending
+        ), return_exceptions=True)
+        
+        sent = 0
+        for (chat_id, text), result in zip(pending, results):
+            if isinstance(result, RetryAfter):
+                # Flood controlled: keep it for the next flush
+                self.notify_queue.append((chat_id, text))
+            elif isinstance(result, Forbidden):
+                pass  # User blocked the bot or never started it
+            elif isinstance(result, BadRequest):
+                logger.warning(f"Could not notify {chat_id}: {result}")
+            elif isinstance(result, Exception):
+                logger.error(f"Error notifying {chat_id}: {result}")
+            else:
+                sent += 1
+        
+        if self.notify_queue:
+            logger.warning(f"Deferred {len(self.notify_queue)} notifications until flood control lifts")
+        
+        return sent
+    
+    async def scan_subscription_expiry(self, now):
+        """Split one expiry scan into expired members (user_id, sub_type, order_id) and expiring (user_id, sub_type, expires_date)"""
+        soon = (datetime.fromisoformat(now) + EXPIRY_REMINDER_WINDOW).strftime('%Y-%m-%d %H:%M:%S')
+        rows = await self.run_read(self.read_fetchall, SQL_SCAN_EXPIRY, {'now': now, 'soon': soon})
+        
+        expired_users, expiring_users = [], []
+        for user_id, sub_type, order_id, expires_date, kind in rows:
+            if kind == 'expired':
+                expired_users.append((user_id, sub_type, order_id))
+            else:
+                expiring_users.append((user_id, sub_type, expires_date))
+        
+        return expired_users, expiring_users
+    
+    async def remove_expired_users_from_group(self, now=None, expired_users=None):
         """Remove users with expired subscriptions from the group"""
-        expired_users = await self.find_expired_users_in_group()
+        if expired_users is None:
+            expired_users = await self.find_expired_user_ids(now)
         
         if not expired_users:
             logger.info("No expired users found in the group.")
             return 0
         
-        removed_count = 0
+        results = await asyncio.gather(*(
+            self.ban_expired_user(user_id, sub_type, order_id)
+            for user_id, sub_type, order_id in expired_users
+        ), return_exceptions=True)
         
-        for user_id, username, first_name, last_name, sub_type, expires_date, order_id in expired_users:
-            try:
-                # Remove user from group
-                await self.application.bot.ban_chat_member(GROUP_CHAT_ID, user_id)
-                await asyncio.sleep(1)  # Rate limiting
-                
-                # Update database
-                conn = sqlite3.connect('payments.db')
-                cursor = conn.cursor()
-                cursor.execute('UPDATE users SET in_group = FALSE WHERE user_id = ?', (user_id,))
-                conn.commit()
-                conn.close()
-                
-                removed_count += 1
-                logger.info(f"Removed expired user from group: {user_id} (Order: {order_id})")
-                
-                # Send notification to user
-                try:
-                    await self.application.bot.send_message(
-                        chat_id=user_id,
-                        text=f"❌ Your {sub_type} subscription has expired. You've been removed from the group. Please renew to regain access."
-                    )
-                except:
-                    pass  # Could not send message
-                    
-            except Exception as e:
-                logger.error(f"Error removing user {user_id}: {e}")
+        banned = []
+        for (user_id, *_), result in zip(expired_users, results):
+            if isinstance(result, Exception):
+                logger.error(f"Error removing user {user_id}: {result}")
+            else:
+                banned.append(user_id)
         
-        return removed_count
+        # Update database in one transaction
+        await self.mark_users_removed(banned)
+        
+        return len(banned)
+    
+    async def mark_users_removed(self, user_ids):
+        """Flag removed users as no longer in the group with a single batched UPDATE"""
+        if user_ids:
+            await self.run_db(self.db_executemany, SQL_SET_IN_GROUP, [(False, uid) for uid in user_ids])
+            self.invalidate_group_caches()
     
     async def remove_expired_users(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Remove users with expired subscriptions from the group (admin command)"""
@@ -848,226 +1176,158 @@ class PaymentBot:
             await update.message.reply_text("✅ No expired users found in the group.")
             return 0
         
-        removed_count = 0
-        message = "🔍 Removing expired users:\n\n"
+        results = await asyncio.gather(*(
+            self.ban_expired_user(user_id, sub_type, order_id)
+            for user_id, username, first_name, last_name, sub_type, expires_date, order_id in expired_users
+        ), return_exceptions=True)
         
-        for user_id, username, first_name, last_name, sub_type, expires_date, order_id in expired_users:
-            try:
-                # Remove user from group
-                await self.application.bot.ban_chat_member(GROUP_CHAT_ID, user_id)
-                await asyncio.sleep(1)  # Rate limiting
-                
-                # Update database
-                conn = sqlite3.connect('payments.db')
-                cursor = conn.cursor()
-                cursor.execute('UPDATE users SET in_group = FALSE WHERE user_id = ?', (user_id,))
-                conn.commit()
-                conn.close()
-                
-                removed_count += 1
-                message += f"❌ Removed {first_name} {last_name} (@{username}) - {sub_type} expired on {expires_date} (Order: {order_id})\n"
-                logger.info(f"Removed expired user from group: {user_id} (Order: {order_id})")
-                
-                # Send notification to user
-                try:
-                    await self.application.bot.send_message(
-                        chat_id=user_id,
-                        text=f"❌ Your {sub_type} subscription has expired. You've been removed from the group. Please renew to regain access."
-                    )
-                except:
-                    pass  # Could not send message
-                    
-            except Exception as e:
-                logger.error(f"Error removing user {user_id}: {e}")
-                message += f"⚠️ Failed to remove {first_name} {last_name}: {e}\n"
+        banned = []
+        lines = ["🔍 Removing expired users:\n\n"]
+        
+        for (user_id, username, first_name, last_name, sub_type, expires_date, order_id), result in zip(expired_users, results):
+            if isinstance(result, Exception):
+                logger.error(f"Error removing user {user_id}: {result}")
+                lines.append(f"⚠️ Failed to remove {first_name} {last_name}: {result}\n")
+            else:
+                banned.append(user_id)
+                lines.append(f"❌ Removed {first_name} {last_name} (@{username}) - {sub_type} expired on {expires_date} (Order: {order_id})\n")
+        
+        # Update database in one transaction
+        await self.mark_users_removed(banned)
+        await self.flush_notifications()
+        removed_count = len(banned)
         
-        message += f"\n✅ Removed {removed_count} expired users."
-        await update.message.reply_text(message)
+        lines.append(f"\n✅ Removed {removed_count} expired users.")
+        
+        # Long removal lists are sent as several messages to stay under Telegram's limit
+        for chunk in split_message(lines):
+            await update.message.reply_text(chunk)
         return removed_count
     
     async def automated_group_management(self):
-        """Automated group management every 3 hours"""
-        while True:
-            try:
-                # Wait for next check
-                await asyncio.sleep(GROUP_CHECK_INTERVAL)
-                
-                # Check storage before proceeding
-                storage_info = self.calculate_storage_usage()
-                if storage_info and storage_info['available_mb'] < 10:
-                    logger.warning("Low storage available, skipping group check")
-                    continue
-                
-                logger.info("Starting automated group management")
-                
-                # 1. Check current group members
-                await self.check_group_members()
-                
-                # 2. Find and add missing users
-                added_count = await self.add_missing_users_to_group()
-                
-                # 3. Find and remove expired users
-                removed_count = await self.remove_expired_users_from_group()
-                
-                if added_count > 0 or removed_count > 0:
-                    logger.info(f"Added {added_count} missing users, removed {removed_count} expired users")
-                    # Notify admin
-                    try:
-                        await self.application.bot.send_message(
-                            chat_id=ADMIN_IDS[0],
-                            text=f"🔄 Group management:\n✅ Added {added_count} missing users\n❌ Removed {removed_count} expired users"
-                        )
-                    except:
-                        pass
-                
-                # 4. Clean up old data if needed
-                storage_info = self.calculate_storage_usage()
-                if storage_info and storage_info['available_mb'] < RESERVED_STORAGE_MB:
-                    self.cleanup_oldest_csv()
-                
-            except Exception as e:
-                logger.error(f"Error in automated group management: {e}")
-                await asyncio.sleep(300)  # Wait 5 minutes before retrying
+        """Automated group management pass (scheduled every GROUP_CHECK_INTERVAL)"""
+        # Check storage before proceeding
+        storage_info = self.calculate_storage_usage()
+        if storage_info:
+            await self.record_storage_usage(storage_info)
+        if storage_info and storage_info['available_mb'] < 10:
+            logger.warning("Low storage available, skipping group check")
+            return
+        
+        logger.info("Starting automated group management")
+        
+        # 1. Check current group members
+        await self.check_group_members()
+        
+        # One timestamp for the whole pass so both scans see the same cutoff
+        now = utc_now_sql()
+        
+        added_count = removed_count = 0
+        try:
+            # 2. Find and add missing users
+            added_count = await self.add_missing_users_to_group(now)
+            
+            # Don't keep hammering the API once Telegram has asked us to back off
+            self.check_flood_wait()
+            
+            # 3. Remove expired users, using the same scan that finds expiring ones
+            expired_users, expiring_users = await self.scan_subscription_expiry(now)
+            self.expiry_scan = (time.monotonic(), expiring_users)  # Reused by the daily reminder job
+            removed_count = await self.remove_expired_users_from_group(now, expired_users)
+            
+            # Bans that hit flood control are retried once it lifts rather than next pass
+            self.check_flood_wait()
+        finally:
+            # Report what did happen even when flood control cuts the pass short
+            if added_count > 0 or removed_count > 0:
+                logger.info(f"Added {added_count} missing users, removed {removed_count} expired users")
+                # One digest for the admin per pass
+                self.notify_queue.append(
+                    (ADMIN_IDS[0], f"🔄 Group management:\n✅ Added {added_count} missing users\n❌ Removed {removed_count} expired users")
+                )
+        
+        # 4. Clean up old data if needed
+        storage_info = self.calculate_storage_usage()
+        if storage_info and storage_info['available_mb'] < RESERVED_STORAGE_MB:
+            self.cleanup_oldest_csv()
     
     async def automated_csv_downloader(self):
-        """Automated CSV download with storage management"""
-        while True:
-            try:
-                if not self.credentials_configured:
-                    await asyncio.sleep(CSV_DOWNLOAD_INTERVAL)
-                    continue
-                
-                # Wait for next download
-                await asyncio.sleep(CSV_DOWNLOAD_INTERVAL)
-                
-                # Check storage and cleanup if needed
-                if not self.should_download_more_data():
-                    logger.warning("Storage limit reached, cleaning up before download")
-                    if not self.cleanup_oldest_csv():
-                        logger.error("Could not free up space for download")
-                        continue
-                
-                # Download with storage management
-                success, filename = await self.download_with_storage_management()
-                
-                if success:
-                    # Record download with file size
-                    file_size_mb = os.path.getsize(filename) / 1024 / 1024 if os.path.exists(filename) else 0
-                    
-                    conn = sqlite3.connect('payments.db')
-                    cursor = conn.cursor()
-                    cursor.execute('''
-                    INSERT INTO download_history (download_time, filename, file_size_mb, payments_processed, status)
-                    VALUES (?, ?, ?, ?, ?)
-                    ''', (datetime.now(), filename, file_size_mb, 0, 'downloaded'))
-                    conn.commit()
-                    conn.close()
-                    
-                    logger.info(f"Downloaded CSV: {filename} ({file_size_mb:.2f} MB)")
-                    
-            except Exception as e:
-                logger.error(f"Error in automated CSV download: {e}")
-                await asyncio.sleep(300)
+        """Automated CSV download with storage management (scheduled every CSV_DOWNLOAD_INTERVAL)"""
+        if not self.credentials_configured:
+            return
+        
+        # Check storage and cleanup if needed
+        if not self.should_download_more_data():
+            logger.warning("Storage limit reached, cleaning up before download")
+            if not self.cleanup_oldest_csv():
+                logger.error("Could not free up space for download")
+                return
+        
+        # Download with storage management
+        success, filename, size_bytes = await self.download_with_storage_management()
+        
+        if success:
+            # Record download with the size measured while writing it
+            file_size_mb = size_bytes / 1024 / 1024
+            
+            await self.run_db(self.db_execute, SQL_RECORD_DOWNLOAD,
+                              (datetime.now(), filename, file_size_mb, 0, 'downloaded'))
+            
+            logger.info(f"Downloaded CSV: {filename} ({file_size_mb:.2f} MB)")
     
     async def check_expiring_subscriptions(self):
-        """Check for subscriptions that will expire soon"""
-        while True:
-            try:
-                await asyncio.sleep(86400)  # Check once per day
-                
-                conn = sqlite3.connect('payments.db')
-                cursor = conn.cursor()
-                
-                # Find subscriptions expiring in the next 3 days
-                cursor.execute('''
-                SELECT u.user_id, u.username, u.first_name, p.subscription_type, p.expires_date
-                FROM users u
-                JOIN payments p ON u.user_id = p.user_id
-                WHERE p.expires_date BETWEEN datetime('now') AND datetime('now', '+3 days')
-                AND p.status = 'completed'
-                ''')
-                
-                expiring_users = cursor.fetchall()
-                conn.close()
-                
-                for user_id, username, first_name, sub_type, expires_date in expiring_users:
-                    try:
-                        await self.application.bot.send_message(
-                            chat_id=user_id,
-                            text=f"⚠️ Your {sub_type} subscription will expire on {expires_date}. Please renew to maintain access to the group."
-                        )
-                    except:
-                        pass  # Could not send message
-                
-            except Exception as e:
-                logger.error(f"Error checking expiring subscriptions: {e}")
+        """Remind users whose subscriptions expire soon (scheduled every EXPIRY_REMINDER_INTERVAL)"""
+        # Reuse the last group pass's scan unless that pass was skipped or failed
+        scanned_at, expiring_users = self.expiry_scan
+        if expiring_users is None or time.monotonic() - scanned_at >= GROUP_CHECK_INTERVAL:
+            expired_users, expiring_users = await self.scan_subscription_expiry(utc_now_sql())
+        
+        for user_id, sub_type, expires_date in expiring_users:
+            self.notify_queue.append(
+                (user_id, f"⚠️ Your {sub_type} subscription will expire on {expires_date}. Please renew to maintain access to the group.")
+            )
     
-    async def check_expired_subscriptions(self):
-        """Background task to check for expired subscriptions"""
+    async def run_scheduler(self):
+        """Run all periodic jobs from a single task, always waking for the job due next"""
+        jobs = {
+            'csv_download': (self.automated_csv_downloader, CSV_DOWNLOAD_INTERVAL),
+            'group_management': (self.automated_group_management, GROUP_CHECK_INTERVAL),
+            'expiring_subscriptions': (self.check_expiring_subscriptions, EXPIRY_REMINDER_INTERVAL),
+            'notifications': (self.flush_notifications, NOTIFY_RETRY_INTERVAL),
+        }
+        
+        # Min-heap of (due time, job name); every job first runs one interval after startup
+        now = time.monotonic()
+        schedule = [(now + interval, name) for name, (job, interval) in jobs.items()]
+        heapq.heapify(schedule)
+        
         while True:
+            due, name = heapq.heappop(schedule)
+            await asyncio.sleep(max(0, due - time.monotonic()))
+            
+            job, interval = jobs[name]
             try:
-                await asyncio.sleep(43200)  # Check twice per day
-                
-                # Find and remove expired users
-                expired_users = await self.find_expired_users_in_group()
-                removed_count = 0
-                
-                for user_id, username, first_name, last_name, sub_type, expires_date, order_id in expired_users:
-                    try:
-                        # Remove user from group
-                        await self.application.bot.ban_chat_member(GROUP_CHAT_ID, user_id)
-                        await asyncio.sleep(1)  # Rate limiting
-                        
-                        # Update database
-                        conn = sqlite3.connect('payments.db')
-                        cursor = conn.cursor()
-                        cursor.execute('UPDATE users SET in_group = FALSE WHERE user_id = ?', (user_id,))
-                        conn.commit()
-                        conn.close()
-                        
-                        removed_count += 1
-                        logger.info(f"Automatically removed expired user from group: {user_id} (Order: {order_id})")
-                        
-                        # Send notification to user
-                        try:
-                            await self.application.bot.send_message(
-                                chat_id=user_id,
-                                text=f"❌ Your {sub_type} subscription has expired. You've been removed from the group. Please renew to regain access."
-                            )
-                        except:
-                            pass  # Could not send message
-                            
-                    except Exception as e:
-                        logger.error(f"Error automatically removing user {user_id}: {e}")
-                
-                if removed_count > 0:
-                    logger.info(f"Automatically removed {removed_count} expired users")
-                
+                await job()
+                next_run = interval
+            except RetryAfter as e:
+                logger.warning(f"Scheduled job {name} hit flood control, retrying in {e.retry_after}s")
+                next_run = e.retry_after
             except Exception as e:
-                logger.error(f"Error in expired subscription check: {e}")
+                logger.error(f"Error in scheduled job {name}: {e}")
+                next_run = JOB_RETRY_DELAY
+            
+            # Deliver everything the job queued in one concurrent batch
+            await self.flush_notifications()
+            
+            heapq.heappush(schedule, (time.monotonic() + next_run, name))
     
     def start_background_tasks(self):
-        """Start all background tasks"""
+        """Start the background job scheduler"""
         loop = asyncio.get_event_loop()
         
-        # CSV download task
-        task1 = loop.create_task(self.automated_csv_downloader())
-        self.background_tasks.add(task1)
-        task1.add_done_callback(self.background_tasks.discard)
-        
-        # Group management task
-        task2 = loop.create_task(self.automated_group_management())
-        self.background_tasks.add(task2)
-        task2.add_done_callback(self.background_tasks.discard)
-        
-        # Subscription tasks
-        task3 = loop.create_task(self.check_expiring_subscriptions())
-        self.background_tasks.add(task3)
-        task3.add_done_callback(self.background_tasks.discard)
-        
-        task4 = loop.create_task(self.check_expired_subscriptions())
-        self.background_tasks.add(task4)
-        task4.add_done_callback(self.background_tasks.discard)
+        task = loop.create_task(self.run_scheduler())
+        self.background_tasks.add(task)
+        task.add_done_callback(self.background_tasks.discard)
     
     async def storage_status(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Check current storage usage"""
@@ -1112,37 +1372,11 @@ class PaymentBot:
             return
         
         try:
-            conn = sqlite3.connect('payments.db')
-            cursor = conn.cursor()
-            
-            # Get group member count
-            cursor.execute('SELECT COUNT(*) FROM group_members')
-            group_count = cursor.fetchone()[0]
-            
-            # Get paid users not in group
-            cursor.execute('''
-            SELECT COUNT(*) FROM users u
-            JOIN payments p ON u.user_id = p.user_id
-            WHERE p.status = 'completed' AND u.in_group = FALSE
-            AND p.expires_date > datetime('now')
-            ''')
-            missing_count = cursor.fetchone()[0]
-            
-            # Get expired users still in group
-            cursor.execute('''
-            SELECT COUNT(*) FROM users u
-            JOIN payments p ON u.user_id = p.user_id
-            WHERE u.in_group = TRUE 
-            AND p.expires_date < datetime('now')
-            AND p.status = 'completed'
-            ''')
-            expired_count = cursor.fetchone()[0]
-            
-            # Get last check time
-            cursor.execute('SELECT MAX(last_checked) FROM group_members')
-            last_check = cursor.fetchone()[0]
-            
-            conn.close()
+            queried_at, counters = self.group_stats_cache
+            if counters is None or time.monotonic() - queried_at >= ADMIN_CACHE_TTL:
+                counters = await self.run_read(self.read_fetchone, SQL_GROUP_STATS, {'now': utc_now_sql()})
+                self.group_stats_cache = (time.monotonic(), counters)
+            group_count, missing_count, expired_count, last_check = counters
             
             stats_text = f"""
 👥 **Group Statistics**
@@ -1179,6 +1413,7 @@ class PaymentBot:
         await update.message.reply_text("🔍 Searching for missing users...")
         
         added_count = await self.add_missing_users_to_group()
+        await self.flush_notifications()
         
         if added_count > 0:
             await update.message.reply_text(f"✅ Added {added_count} missing users to group")
@@ -1187,7 +1422,26 @@ class PaymentBot:
 
     def run(self):
         """Run the bot"""
-        self.application.run_polling()
+        try:
+            if WEBHOOK_URL:
+                # Telegram pushes updates to us, so there is no getUpdates loop to keep running
+                self.application.run_webhook(
+                    listen='0.0.0.0',
+                    port=PORT,
+                    url_path=BOT_TOKEN,
+                    webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{BOT_TOKEN}"
+                )
+            else:
+                self.application.run_polling()
+        finally:
+            self.read_executor.shutdown(wait=True)
+            # Every SELECT runs here, so this is where the planner recorded which tables need stats
+            self.read_conn.execute('PRAGMA query_only = OFF')
+            self.read_conn.execute('PRAGMA optimize')
+            self.read_conn.close()
+            self.db_executor.shutdown(wait=True)
+            self.conn.execute('PRAGMA optimize')
+            self.conn.close()
 
 if __name__ == "__main__":
     bot = PaymentBot()